@@ -2,19 +2,61 @@
 import sys  # For system-specific parameters and functions
 import subprocess  # For running system commands
 import os  # For interacting with the operating system
+import shlex  # For quoting shell commands
+import shutil  # For locating required commands
+import hashlib  # For recognizing an unchanged background
+import re  # For parsing xrandr output
+from concurrent.futures import ThreadPoolExecutor  # For resizing images in parallel
 
 # Import required PySide6 modules for GUI
-from PySide6.QtWidgets import (QApplication, QMainWindow, QPushButton, QLabel,
+from PySide6.QtWidgets import (QApplication, QMainWindow, QPushButton,
                                 QVBoxLayout, QWidget, QFileDialog, QHBoxLayout, QLineEdit)
-from PySide6.QtGui import QPixmap, QPalette, QColor
-from PySide6.QtCore import Qt
-
-# Import PIL for image processing
-from PIL import Image
+from PySide6.QtGui import QPalette, QColor
+from PySide6.QtCore import Qt, QObject, QProcess, QRunnable, QThreadPool, Signal
+
+# PIL is imported where images are processed, so the window can show without loading it
+
+# PyGObject is optional; without it settings are changed through the gsettings command
+try:
+    from gi.repository import Gio
+except ImportError:
+    Gio = None
+
+BACKGROUND_SCHEMA = "org.cinnamon.desktop.background"
+MAX_RESIZE_WORKERS = 8  # Upper bound on images decoded and resized at the same time
+JPEG_QUALITY = 85  # Quality of the saved wallpaper; the compositor rescales it anyway
+
+# Matches a monitor line in `xrandr --listmonitors`, e.g. " 0: +*DP-1 2560/597x1440/336+0+0  DP-1"
+XRANDR_MONITOR_RE = re.compile(r"^\s*\d+:\s+\S+\s+(\d+)/\d+x(\d+)/\d+\+(\d+)\+(\d+)\s+(\S+)", re.M)
+
+class BackgroundAssemblerSignals(QObject):
+    # QRunnable isn't a QObject, so the worker's signals live on this companion object
+    finished = Signal(str)  # Path of the assembled image
+    failed = Signal(str)  # Error message
+
+class BackgroundAssembler(QRunnable):
+    # Runs the image assembly on a QThreadPool thread so the UI keeps repainting
+    def __init__(self, assemble, image_paths):
+        super(BackgroundAssembler, self).__init__()
+        self.assemble = assemble
+        self.image_paths = image_paths
+        self.signals = BackgroundAssemblerSignals()
+
+    def run(self):
+        try:
+            output_path = self.assemble(self.image_paths)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(output_path)
 
 class MultiMonitorApp(QMainWindow):
     def __init__(self):
         super(MultiMonitorApp, self).__init__()
+        self.monitors_cache = None  # Monitor layout detected by xrandr, reused across Apply clicks
+        self.deps_ok = False  # Set once all required commands have been found
+        self.dark_mode = self.isSystemInDarkMode()  # Query gsettings once for the whole UI
+        self.background_settings = self.loadSettings(BACKGROUND_SCHEMA)  # None when Gio can't be used
         self.initUI()  # Initialize the user interface
         self.files = []  # List to store selected image files
         self.handleDarkMode()  # Set up dark mode if system is using it
@@ -33,10 +75,11 @@ class MultiMonitorApp(QMainWindow):
         # Create file selection layout
         file_layout = QHBoxLayout()
         self.file_inputs = [QLineEdit(self), QLineEdit(self)]
+        # Set style based on dark mode
+        file_input_style = "color: white; background-color: #353535;" if self.dark_mode else "color: black; background-color: white;"
         for file_input in self.file_inputs:
             file_input.setPlaceholderText("Select an image file")
-            # Set style based on dark mode
-            file_input.setStyleSheet("color: white; background-color: #353535;" if self.isSystemInDarkMode() else "color: black; background-color: white;")
+            file_input.setStyleSheet(file_input_style)
             file_layout.addWidget(file_input)
 
             # Add browse button for each file input
@@ -49,9 +92,14 @@ class MultiMonitorApp(QMainWindow):
         # Create buttons layout (Apply, Cancel, Quit)
         button_layout = QHBoxLayout()
 
-        ok_button = QPushButton("Apply", self)
-        ok_button.clicked.connect(self.setBackground)
-        button_layout.addWidget(ok_button)
+        self.ok_button = QPushButton("Apply", self)
+        self.ok_button.clicked.connect(self.setBackground)
+        button_layout.addWidget(self.ok_button)
+
+        # Re-detect monitors after the display layout changes; the layout is cached otherwise
+        refresh_button = QPushButton("Refresh Monitors", self)
+        refresh_button.clicked.connect(self.refreshMonitors)
+        button_layout.addWidget(refresh_button)
 
         cancel_button = QPushButton("Cancel", self)
         cancel_button.clicked.connect(self.clearInputs)
@@ -82,34 +130,59 @@ class MultiMonitorApp(QMainWindow):
             self.statusBar().showMessage("Please select at least one image file.") 
             return
 
+        # Check the files exist before running xrandr and allocating the canvas
+        missing = [file for file in self.files if not os.path.isfile(file)]
+        if missing:
+            self.statusBar().showMessage(f"Image file not found: {', '.join(missing)}")
+            return
+
         # Validate required dependencies
         if not self.validateDependencies():
-            self.statusBar().showMessage("Missing required dependencies (gsettings, xrandr, ImageMagick).")
+            self.statusBar().showMessage("Missing required dependencies (gsettings, xrandr).")
             return
 
-        # Set background
-        try:
-            self.assembleBackgroundImage(self.files)
-            success = self.applyBackground()
-            if success:
-                self.statusBar().showMessage("Background applied successfully. Please wait a moment for the changes to reflect.")
-            else:
-                self.statusBar().showMessage("Failed to apply background. Check logs for errors.")
-        except Exception as e:
-            print(f"Error setting background: {e}")
-            self.statusBar().showMessage(f"Error setting background: {e}")
+        # Set background. The image is assembled on a worker thread and applied once it's ready
+        # Apply stays disabled until this run finishes, so two runs never write the image at once
+        self.ok_button.setEnabled(False)
+        self.statusBar().showMessage("Assembling background image...")
+        worker = BackgroundAssembler(self.assembleBackgroundImage, self.files)
+        worker.signals.finished.connect(self.applyBackground)
+        worker.signals.failed.connect(self.handleBackgroundError)
+        self.background_worker = worker  # Keep the signals alive until they're delivered
+        QThreadPool.globalInstance().start(worker)
+
+    def finishBackground(self, message):
+        # Report the outcome of an Apply run and allow the next one
+        self.ok_button.setEnabled(True)
+        self.statusBar().showMessage(message)
+
+    def handleBackgroundError(self, message):
+        print(f"Error setting background: {message}")
+        self.finishBackground(f"Error setting background: {message}")
+
+    def assembleBackgroundImage(self, image_paths, resample=None):
+        from PIL import Image
 
-    def assembleBackgroundImage(self, image_paths):
         monitors = self.getMonitorsGeometry()
         output_dir = os.path.expanduser("~/.cinnamon/backgrounds")
         output_path = os.path.join(output_dir, "multiMonitorBackground.jpg")
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Skip assembly when the same images were already composed for the same layout
+        cache_key_path = os.path.join(output_dir, ".cache_key")
+        cache_key = self.backgroundCacheKey(image_paths, monitors, resample)
+        if os.path.exists(output_path) and os.path.exists(cache_key_path):
+            with open(cache_key_path) as cache_key_file:
+                if cache_key_file.read() == cache_key:
+                    print(f"Background image is up to date: {output_path}")
+                    return output_path
 
         # Calculate total width and height
-        total_width = max(monitor['offset'][0] + int(monitor['geometry'].split('x')[0]) for monitor in monitors)
-        total_height = max(monitor['offset'][1] + int(monitor['geometry'].split('x')[1]) for monitor in monitors)
+        total_width = total_height = 0
+        for monitor in monitors:
+            total_width = max(total_width, monitor['offset'][0] + monitor['width'])
+            total_height = max(total_height, monitor['offset'][1] + monitor['height'])
 
         print(f"Total screen size: {total_width}x{total_height}")
         print(f"Number of monitors: {len(monitors)}")
@@ -117,96 +190,200 @@ class MultiMonitorApp(QMainWindow):
         # Create a blank canvas for the full screen size
         background = Image.new('RGB', (total_width, total_height), (0, 0, 0))
 
+        temp_path = output_path + ".tmp"
         try:
-            for i, monitor in enumerate(monitors):
-                geometry = monitor['geometry']
-                offset_x, offset_y = monitor['offset']
-                image_path = image_paths[i % len(image_paths)]
-
-                print(f"Monitor {i} ({monitor['name']}): geometry={geometry}, offset=({offset_x}, {offset_y})")
-
-                # Open and resize the image
-                with Image.open(image_path) as img:
-                    img = img.convert('RGB')  # Ensure the image is in RGB mode
-                    mon_width, mon_height = map(int, geometry.split('x'))
-                    img.thumbnail((mon_width, mon_height), Image.LANCZOS)
-
-                    print(f"  Image size after resize: {img.width}x{img.height}")
-
-                    # Create a new image with the correct size and paste the resized image
-                    monitor_img = Image.new('RGB', (mon_width, mon_height), (0, 0, 0))
+            # Decode and resize monitor images on worker threads; Pillow releases the GIL
+            # while decoding and resampling. Monitors showing the same file at the same
+            # resolution share a single decode and resize. The pool is capped so large
+            # video walls don't hold a full-size decoded image per monitor at once
+            with ThreadPoolExecutor(max_workers=min(MAX_RESIZE_WORKERS, len(monitors))) as executor:
+                resized = {}
+                placements = []
+                for i, monitor in enumerate(monitors):
+                    geometry = monitor['geometry']
+                    offset_x, offset_y = monitor['offset']
+                    image_path = image_paths[i % len(image_paths)]
+
+                    print(f"Monitor {i} ({monitor['name']}): geometry={geometry}, offset=({offset_x}, {offset_y})")
+
+                    mon_width, mon_height = monitor['width'], monitor['height']
+                    key = (image_path, mon_width, mon_height)
+                    if key not in resized:
+                        resized[key] = executor.submit(self.resizeImage, image_path, (mon_width, mon_height), resample)
+                    placements.append((offset_x, offset_y, mon_width, mon_height, resized[key]))
+
+                # Pasting stays on this thread, in monitor order, since the canvas is
+                # shared and mirrored outputs overlap
+                for offset_x, offset_y, mon_width, mon_height, future in placements:
+                    img = future.result()
+
+                    # Clear the monitor area first, so an overlapping (mirrored) monitor's
+                    # letterbox bars cover the image pasted before it, then center the
+                    # resized image within it
+                    background.paste((0, 0, 0), (offset_x, offset_y, offset_x + mon_width, offset_y + mon_height))
                     paste_x = (mon_width - img.width) // 2
                     paste_y = (mon_height - img.height) // 2
-                    monitor_img.paste(img, (paste_x, paste_y))
-
-                    # Paste the monitor image onto the main canvas
-                    background.paste(monitor_img, (offset_x, offset_y))
-
-            # Save the final image
-            background.save(output_path, 'JPEG', quality=95)
+                    background.paste(img, (offset_x + paste_x, offset_y + paste_y))
+
+            # Save the final image to a temporary file, then rename it into place
+            background.save(temp_path, 'JPEG', quality=JPEG_QUALITY, subsampling=2, optimize=False, progressive=False)
+            # Drop the old key first, so a failure below can't pair it with the new image
+            if os.path.exists(cache_key_path):
+                os.remove(cache_key_path)
+            os.replace(temp_path, output_path)
             print(f"Saved background image to: {output_path}")
 
+            with open(cache_key_path + ".tmp", "w") as cache_key_file:
+                cache_key_file.write(cache_key)
+            os.replace(cache_key_path + ".tmp", cache_key_path)
+
         except Exception as e:
             print(f"Error assembling background image: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
             raise
 
         return output_path
 
-    def applyBackground(self):
-        output_path = os.path.expanduser("~/.cinnamon/backgrounds/multiMonitorBackground.jpg")
-        try:
+    def backgroundCacheKey(self, image_paths, monitors, resample):
+        # Identify a composite by its sources (order matters, it decides which monitor shows
+        # which image), their modification times, the monitor layout and the encode settings
+        sources = []
+        for image_path in image_paths:
+            stat = os.stat(image_path)
+            sources.append((os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size))
+        layout = [(monitor['width'], monitor['height'], monitor['offset']) for monitor in monitors]
+        key_data = repr((sources, layout, resample, JPEG_QUALITY)).encode()
+        return hashlib.blake2b(key_data, digest_size=16).hexdigest()
+
+    def resizeImage(self, image_path, size, resample=None):
+        from PIL import Image
+
+        # Open and resize the image to fit within size
+        with Image.open(image_path) as img:
+            # Let JPEGs decode at a reduced scale that still covers size
+            img.draft('RGB', size)
+            # Give palette transparency a real alpha channel, flattened after the resize
+            if img.mode == 'PA' or (img.mode not in ('RGBA', 'LA') and 'transparency' in img.info):
+                img = img.convert('RGBA')
+            has_alpha = img.mode in ('RGBA', 'LA')
+            # Ensure the image is in RGB mode
+            if img.mode != 'RGB' and not has_alpha:
+                img = img.convert('RGB')
+            img.thumbnail(size, resample if resample is not None else self.chooseResampleFilter(img.size, size))
+            # Read the pixels while the file is open; thumbnail() skips images that already fit
+            img.load()
+
+        if has_alpha:
+            # Transparent areas show the black canvas, as they would once pasted onto it
+            flattened = Image.new('RGB', img.size, (0, 0, 0))
+            flattened.paste(img, mask=img.getchannel('A'))
+            img = flattened
+
+        print(f"  Image size after resize: {img.width}x{img.height}")
+        return img
+
+    def chooseResampleFilter(self, image_size, size):
+        from PIL import Image
+
+        # thumbnail() never upscales, so only downscaling needs a filter. When the image
+        # shrinks by a whole-number factor of 2 or more, each output pixel averages a
+        # block of source pixels; BOX is a little softer than LANCZOS there but much
+        # cheaper. Near a factor of 1 BOX would drop rows and columns, so keep LANCZOS
+        scale = min(size[0] / image_size[0], size[1] / image_size[1])
+        if scale < 1:
+            factor = 1 / scale
+            if round(factor) >= 2 and abs(factor - round(factor)) < 0.01:
+                return Image.BOX
+        return Image.LANCZOS
+
+    def applyBackground(self, output_path):
+        picture_uri = f"file://{output_path}"
+        settings = [
             # Set the background for all monitors
-            subprocess.check_call([
-                "gsettings", "set",
-                "org.cinnamon.desktop.background",
-                "picture-uri", f"file://{output_path}"
-            ])
-            subprocess.check_call([
-                "gsettings", "set",
-                "org.cinnamon.desktop.background",
-                "picture-options", "spanned"
-            ])
-
+            ("picture-uri", picture_uri),
+            ("picture-options", "spanned"),
             # Refresh the Cinnamon settings
-            subprocess.check_call(["gsettings", "set", "org.cinnamon.desktop.background", "picture-uri", "''"])
-            subprocess.check_call(["gsettings", "set", "org.cinnamon.desktop.background", "picture-uri", f"file://{output_path}"])
+            ("picture-uri", ""),
+            ("picture-uri", picture_uri),
+        ]
+
+        if self.background_settings is not None:
+            # Write the keys in-process instead of spawning gsettings
+            success = True
+            for key, value in settings:
+                if not self.background_settings.set_string(key, value):
+                    success = False
+                    break
+                if key == "picture-uri" and not value:
+                    # Flush the reset on its own; dconf would otherwise merge it into the
+                    # final write and Cinnamon would only see the URI it already had
+                    Gio.Settings.sync()
+            Gio.Settings.sync()
+            if success:
+                self.finishBackground("Background applied successfully. Please wait a moment for the changes to reflect.")
+            else:
+                print(f"Error applying background: {BACKGROUND_SCHEMA} is not writable")
+                self.finishBackground("Failed to apply background. Check logs for errors.")
+            return
 
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error applying background: {e}")
-            return False
+        # gsettings parses values as GVariant text, so the empty string has to be spelled ''
+        commands = [["gsettings", "set", BACKGROUND_SCHEMA, key, value or "''"] for key, value in settings]
+
+        # Run all the calls from a single shell instead of spawning one process per call,
+        # through QProcess so the UI thread doesn't wait for them to finish
+        script = " && ".join(" ".join(shlex.quote(arg) for arg in command) for command in commands)
+        self.apply_process = QProcess(self)
+        self.apply_process.finished.connect(self.handleApplyFinished)
+        self.apply_process.errorOccurred.connect(self.handleApplyError)
+        self.apply_process.start("/bin/sh", ["-c", script])
+
+    def handleApplyFinished(self, exit_code, exit_status):
+        self.releaseApplyProcess()
+        if exit_status == QProcess.NormalExit and exit_code == 0:
+            self.finishBackground("Background applied successfully. Please wait a moment for the changes to reflect.")
+        else:
+            print(f"Error applying background: gsettings exited with status {exit_code}")
+            self.finishBackground("Failed to apply background. Check logs for errors.")
+
+    def releaseApplyProcess(self):
+        # Each Apply creates a new QProcess parented to the window; free it once it's done
+        self.apply_process.deleteLater()
+        self.apply_process = None
+
+    def handleApplyError(self, error):
+        # A process that never started doesn't emit finished, so report it here
+        if error == QProcess.FailedToStart:
+            print(f"Error applying background: {self.apply_process.errorString()}")
+            self.releaseApplyProcess()
+            self.finishBackground("Failed to apply background. Check logs for errors.")
+
+    def refreshMonitors(self):
+        # xrandr has to be available before the layout can be detected
+        if not self.validateDependencies():
+            self.statusBar().showMessage("Missing required dependencies (gsettings, xrandr).")
+            return None
 
-    def getScreenGeometry(self):
-        result = subprocess.run(["xrandr"], capture_output=True, text=True)
-        for line in result.stdout.splitlines():
-            if "current" in line:
-                parts = line.split("current ")[1].split(",")[0].strip().split()
-                if len(parts) >= 2:
-                    return f"{parts[0]}x{parts[2]}"
-        return "1920x1080"  # Default fallback
+        # Drop the cached layout so the next call re-runs xrandr
+        self.monitors_cache = None
+        monitors = self.getMonitorsGeometry()
+        self.statusBar().showMessage(f"Detected {len(monitors)} monitor(s).")
+        return monitors
 
     def getMonitorsGeometry(self):
-        result = subprocess.run(["xrandr", "--query"], capture_output=True, text=True)
-        monitors = []
-        for line in result.stdout.splitlines():
-            if " connected" in line:
-                parts = line.split()
-                name = parts[0]
-                if "primary" in parts:
-                    parts.remove("primary")
-                if len(parts) >= 3:
-                    geometry = parts[2]
-                    if '+' in geometry:
-                        geometry_parts = geometry.split('+')
-                        if len(geometry_parts) >= 3:
-                            size = geometry_parts[0]
-                            offset_x = int(geometry_parts[1])
-                            offset_y = int(geometry_parts[2])
-                            monitors.append({'name': name, 'geometry': size, 'offset': (offset_x, offset_y)})
+        # Reuse the layout from the previous call instead of shelling out to xrandr again
+        if self.monitors_cache is not None:
+            return self.monitors_cache
+
+        # --listmonitors prints one line per active monitor instead of every output and mode
+        result = self.runCommand(["xrandr", "--listmonitors"])
+        monitors = [{'name': match[5], 'geometry': f"{match[1]}x{match[2]}", 'width': int(match[1]), 'height': int(match[2]),
+                     'offset': (int(match[3]), int(match[4]))}
+                    for match in XRANDR_MONITOR_RE.finditer(result.stdout)]
 
         if not monitors:
             # Fallback to a single monitor setup if no valid monitors are detected
-            monitors.append({'name': 'default', 'geometry': '1920x1080', 'offset': (0, 0)})
+            monitors.append({'name': 'default', 'geometry': '1920x1080', 'width': 1920, 'height': 1080, 'offset': (0, 0)})
 
         # Sort monitors by their x offset to ensure correct order
         monitors.sort(key=lambda m: m['offset'][0])
@@ -215,12 +392,13 @@ class MultiMonitorApp(QMainWindow):
         for monitor in monitors:
             print(f"  {monitor['name']}: {monitor['geometry']} at offset {monitor['offset']}")
 
+        self.monitors_cache = monitors
         return monitors
 
     # Set up the palette based on the system's dark mode setting
     def handleDarkMode(self):
         palette = self.palette()
-        if self.isSystemInDarkMode():
+        if self.dark_mode:
             palette.setColor(QPalette.Window, QColor(53, 53, 53))
             palette.setColor(QPalette.WindowText, Qt.white)
             palette.setColor(QPalette.Base, QColor(25, 25, 25))
@@ -234,21 +412,49 @@ class MultiMonitorApp(QMainWindow):
 
         self.setPalette(palette)
 
+    def loadSettings(self, schema):
+        # Open a GSettings schema in-process if PyGObject is installed. Gio.Settings.new()
+        # aborts on a schema that isn't installed, so look it up first
+        if Gio is None:
+            return None
+        source = Gio.SettingsSchemaSource.get_default()
+        if source is None or source.lookup(schema, True) is None:
+            return None
+        return Gio.Settings.new(schema)
+
     def isSystemInDarkMode(self):
+        # Read the key in-process when possible; older GNOME schemas don't have color-scheme
+        interface_settings = self.loadSettings("org.gnome.desktop.interface")
+        if interface_settings is not None and interface_settings.props.settings_schema.has_key("color-scheme"):
+            return 'dark' in interface_settings.get_string("color-scheme").lower()
+
         try:
-            result = subprocess.run(["gsettings", "get", "org.gnome.desktop.interface", "color-scheme"], capture_output=True, text=True)
+            result = self.runCommand(["gsettings", "get", "org.gnome.desktop.interface", "color-scheme"])
             return 'dark' in result.stdout.lower()
         except Exception as e:
             return False
 
     def validateDependencies(self):
-        # Check if required commands are available
-        for command in ["gsettings", "xrandr", "convert"]:
-            if subprocess.call(["which", command], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+        # The commands don't move while the app is running, so only check until they're all found
+        if self.deps_ok:
+            return True
+
+        # Check if required commands are available, walking PATH in-process.
+        # gsettings is only run when the settings can't be written through Gio
+        commands = ["xrandr"] if self.background_settings is not None else ["gsettings", "xrandr"]
+        for command in commands:
+            if shutil.which(command) is None:
                 print(f"Dependency '{command}' is missing.")
                 return False
+
+        self.deps_ok = True
         return True
 
+    def runCommand(self, args):
+        # An absolute path plus close_fds=False lets subprocess use posix_spawn instead of fork
+        command = [shutil.which(args[0]) or args[0]] + args[1:]
+        return subprocess.run(command, capture_output=True, text=True, close_fds=False)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MultiMonitorApp()